@@ -1,10 +1,15 @@
-from __future__ import unicode_literals
 from django.urls import re_path
 from django.contrib.admin import SimpleListFilter, ModelAdmin
+from django.contrib.admin.views.main import ChangeList
 from django.core.exceptions import PermissionDenied
+from django.core.paginator import Paginator
+from django.db import connections
 from django.template.response import TemplateResponse
 from django.utils.encoding import force_str
+from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
+from functools import lru_cache
+from types import MappingProxyType
 import logging
 
 
@@ -30,6 +35,32 @@ PERIOD_CURRENT_LOOKUPS = (
 )
 
 
+_PERIOD_OPTIONS = {
+    'ago': PERIOD_AGO_LOOKUPS,
+    'current': PERIOD_CURRENT_LOOKUPS,
+    'both': PERIOD_AGO_LOOKUPS + PERIOD_CURRENT_LOOKUPS,
+}
+
+
+_TRACKED_STAMPS_METHODS = {
+    'create': 'created_on',
+    'update': 'updated_on',
+    'both': 'created_or_updated_on',
+}
+
+
+def _prefixed_period_options(tracked_stamps, options):
+    """
+    Prefixes the keys of period options by the tracked stamps type, as PeriodFilter expects them.
+    :param tracked_stamps: The tracked stamps type: 'create', 'update', or 'both'.
+    :param options: The period options.
+    :return: The options, with prefixed keys.
+    """
+
+    prefix = tracked_stamps + ':'
+    return type(options)((prefix + k, v) for (k, v) in options)
+
+
 class PeriodFilter(SimpleListFilter):
     """
     Period filter. This will make use of .created_on and .updated_on methods. Its subclasses
@@ -43,17 +74,16 @@ class PeriodFilter(SimpleListFilter):
         """
         Performs lookup in the same way the reporting tool allows to generate a report.
         :param request: Current request
-        :param model_admin: Current model admin. It must implement get_period_options as returning a list of (k, v).
+        :param model_admin: Current model admin. It must have `tracked_stamps` and `get_period_options`.
         :raises: AttributeError, ValueError, or any exception triggered by get_period_options.
-        :return: The result of calling such method.
+        :return: The result of calling such method, prefixed. TrackedLiveAdmin instances compute
+          it once.
         """
 
-        if model_admin.tracked_stamps in {'create', 'update', 'both'}:
-            prefix = model_admin.tracked_stamps + ':'
-        else:
-            raise ValueError("Invalid tracked_stamps type. Expected: 'create', 'update', or 'both'")
-        original = model_admin.get_period_options()
-        return type(original)((prefix + k, v) for (k, v) in original)
+        lookups = getattr(model_admin, '_period_filter_lookups', None)
+        if lookups is None:
+            lookups = _prefixed_period_options(model_admin.tracked_stamps, model_admin.get_period_options())
+        return lookups
 
     def queryset(self, request, queryset):
         """
@@ -66,20 +96,86 @@ class PeriodFilter(SimpleListFilter):
         """
 
         value = self.value()
-        try:
-            if not value:
-                return queryset
-            prefix, period = value.split(':')
-            if prefix == 'create':
-                return queryset.created_on(period)
-            elif prefix == 'update':
-                return queryset.updated_on(period)
-            elif prefix == 'both':
-                return queryset.created_or_updated_on(period)
-            else:
-                return queryset
-        except ValueError:
+        if not value or ':' not in value:
             return queryset
+        prefix, _sep, period = value.partition(':')
+        method = _TRACKED_STAMPS_METHODS.get(prefix)
+        if not (period and method) or ':' in period:
+            return queryset
+        return getattr(queryset, method)(period)
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator which, for unfiltered querysets on PostgreSQL, takes the count from the table
+      statistics instead of performing a full SELECT COUNT(*). Estimated counts below the
+      `estimate_threshold` are discarded, and the exact count is performed instead.
+    To use it, set it as the `paginator` member of the model admin. The changelist also counts
+      all the records (regardless of the filters) when `show_full_result_count` is True, and that
+      count is never estimated: TrackedLiveAdmin subclasses using this paginator set it to False
+      unless they set it on their own. Other admins should set it to False as well.
+    """
+
+    estimate_threshold = 10000
+
+    @cached_property
+    def count(self):
+        """
+        Returns the estimated count, if available, or the exact count.
+        """
+
+        query = getattr(self.object_list, 'query', None)
+        if query is not None and not query.where:
+            connection = connections[self.object_list.db]
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)",
+                                   [connection.ops.quote_name(self.object_list.model._meta.db_table)])
+                    row = cursor.fetchone()
+                if row and row[0] >= self.estimate_threshold:
+                    return row[0]
+        return super(EstimatedCountPaginator, self).count
+
+
+class TrackedChangeListMixin(object):
+    """
+    Changelist mixin prefetching the lookups in the list_prefetch_related member of the model admin,
+      like list_select_related is applied by the regular changelist.
+    """
+
+    def get_queryset(self, request, *args, **kwargs):
+        """
+        Returns the changelist queryset, prefetching the list_prefetch_related lookups (if any).
+        :param request: Current request.
+        :return: The changelist queryset.
+        """
+
+        queryset = super(TrackedChangeListMixin, self).get_queryset(request, *args, **kwargs)
+        list_prefetch_related = getattr(self.model_admin, 'list_prefetch_related', ())
+        if list_prefetch_related:
+            queryset = queryset.prefetch_related(*list_prefetch_related)
+        return queryset
+
+
+class TrackedChangeList(TrackedChangeListMixin, ChangeList):
+    """
+    Regular changelist, also applying list_prefetch_related.
+    """
+
+
+@lru_cache(maxsize=None)
+def _tracked_changelist(changelist):
+    """
+    Combines a changelist class with TrackedChangeListMixin, once per changelist class.
+    :param changelist: The changelist class to combine.
+    :return: A changelist class applying list_prefetch_related.
+    """
+
+    if changelist is ChangeList:
+        return TrackedChangeList
+    if issubclass(changelist, TrackedChangeListMixin):
+        return changelist
+    return type('Tracked' + changelist.__name__, (TrackedChangeListMixin, changelist), {})
 
 
 class TrackedLiveAdmin(ModelAdmin):
@@ -92,6 +188,31 @@ class TrackedLiveAdmin(ModelAdmin):
     report_error_template = None
     report_period_type = 'both'  # Report period types may be: 'current', 'ago', or 'both'
     report_generators = []  # List of available reports
+    list_prefetch_related = ()  # Lookups to prefetch in the changelist
+    _cached_urls = None
+
+    def __init_subclass__(cls, **kwargs):
+        """
+        Validates tracked_stamps, once per admin class. Also disables show_full_result_count (unless
+          set by the class or its bases) when EstimatedCountPaginator is used, since the full count would
+          still be an exact one.
+        :raises: ValueError if tracked_stamps is not valid.
+        """
+
+        super(TrackedLiveAdmin, cls).__init_subclass__(**kwargs)
+        if cls.tracked_stamps not in _TRACKED_STAMPS_METHODS:
+            raise ValueError("Invalid tracked_stamps type. Expected: 'create', 'update', or 'both'")
+        if issubclass(cls.paginator, EstimatedCountPaginator) and \
+           not any('show_full_result_count' in vars(base) for base in cls.__mro__ if base is not ModelAdmin):
+            cls.show_full_result_count = False
+
+    def get_changelist(self, request, **kwargs):
+        """
+        Returns the changelist class (as other bases would), combined with TrackedChangeListMixin
+          so it also applies list_prefetch_related.
+        """
+
+        return _tracked_changelist(super(TrackedLiveAdmin, self).get_changelist(request, **kwargs))
 
     def get_list_filter(self, request):
         """
@@ -103,14 +224,20 @@ class TrackedLiveAdmin(ModelAdmin):
         original = super(TrackedLiveAdmin, self).get_list_filter(request)
         return original + type(original)([PeriodFilter])
 
+    @cached_property
+    def _report_generators_by_key(self):
+        """
+        The report_generators list indexed by key, computed once per admin instance.
+        """
+
+        return MappingProxyType({r.key: r for r in self.report_generators})
+
     def get_reporters(self):
         """
-        Converts the report_generators list to a dictionary, and caches the result.
-        :return: A dictionary with such references.
+        Returns the report_generators list as a dictionary, indexed by key.
+        :return: A read-only dictionary with such references.
         """
 
-        if not hasattr(self, '_report_generators_by_key'):
-            self._report_generators_by_key = {r.key: r for r in self.report_generators}
         return self._report_generators_by_key
 
     def get_period_options(self):
@@ -120,15 +247,30 @@ class TrackedLiveAdmin(ModelAdmin):
         :return: An array of period options.
         """
 
-        if self.report_period_type == 'ago':
-            return PERIOD_AGO_LOOKUPS
-        elif self.report_period_type == 'current':
-            return PERIOD_CURRENT_LOOKUPS
-        elif self.report_period_type == 'both':
-            return PERIOD_AGO_LOOKUPS + PERIOD_CURRENT_LOOKUPS
-        else:
+        try:
+            return _PERIOD_OPTIONS[self.report_period_type]
+        except KeyError:
             raise ValueError("Invalid report period type. Expected: 'ago', 'current', or 'both'")
 
+    @cached_property
+    def _allowed_period_keys(self):
+        """
+        The keys of the options returned by get_period_options, computed once per admin instance.
+        :return: A frozenset of period keys.
+        """
+
+        return frozenset(k for (k, v) in self.get_period_options())
+
+    @cached_property
+    def _period_filter_lookups(self):
+        """
+        The options returned by get_period_options, with keys prefixed by tracked_stamps (as
+          PeriodFilter expects them), computed once per admin instance.
+        """
+
+        # tracked_stamps is validated when the admin class is created.
+        return _prefixed_period_options(self.tracked_stamps, self.get_period_options())
+
     def get_report_options(self):
         """
         Enumerates the report options as a list (suitable for a select) as an array of pairs
@@ -136,32 +278,72 @@ class TrackedLiveAdmin(ModelAdmin):
         :return: An array of period options.
         """
 
-        return [(r.key, r.text) for r in self.report_generators]
+        return [(r.key, r.text) for r in self._report_generators_by_key.values()]
+
+    @cached_property
+    def _tracking_report_url_name(self):
+        """
+        The name of the report url (without the admin namespace).
+        """
+
+        return '%s_%s_tracking_report' % (self.model._meta.app_label, self.model._meta.model_name)
+
+    @cached_property
+    def _report_view_wrapped(self):
+        """
+        The report view, wrapped by the admin site (permission checks, csrf, cache) once per admin instance.
+        """
+
+        return self.admin_site.admin_view(self.report_view)
 
     def get_urls(self):
         """
-        Returns additional urls to add to a result of `get_urls` in a descendant ModelAdmin
+        Returns additional urls to add to a result of `get_urls` in a descendant ModelAdmin.
+          The urls are built once per admin instance (a copy of the list is returned each time).
         :return: A list of url declarations.
         """
 
-        info = self.model._meta.app_label, self.model._meta.model_name
-        return [
-            re_path(r'^report/(?P<key>\w+)/(?P<period>\w)$',
-                    self.admin_site.admin_view(self.report_view),
-                    name='%s_%s_tracking_report' % info)
-        ] + super(TrackedLiveAdmin, self).get_urls()
+        if self._cached_urls is None:
+            self._cached_urls = [
+                re_path(r'^report/(?P<key>\w+)/(?P<period>\w)$',
+                        self._report_view_wrapped,
+                        name=self._tracking_report_url_name)
+            ] + super(TrackedLiveAdmin, self).get_urls()
+        return list(self._cached_urls)
+
+    @cached_property
+    def _changelist_extra_context(self):
+        """
+        The context added to the changelist view. It is computed once per admin instance.
+        """
+
+        return {
+            'url_name': 'admin:' + self._tracking_report_url_name,
+            'period_options': self.get_period_options(),
+            'report_options': self.get_report_options(),
+        }
 
     def changelist_view(self, request, extra_context=None):
         """
         Updates the changelist view to include settings from this admin.
         """
 
-        return super(TrackedLiveAdmin, self).changelist_view(
-            request, dict(extra_context or {},
-                          url_name='admin:%s_%s_tracking_report' % (self.model._meta.app_label, self.model._meta.model_name),
-                          period_options=self.get_period_options(),
-                          report_options=self.get_report_options())
-        )
+        context = dict(extra_context or {})
+        context.update(self._changelist_extra_context)
+        return super(TrackedLiveAdmin, self).changelist_view(request, context)
+
+    @cached_property
+    def _report_error_templates(self):
+        """
+        The default report error templates, when no report_error_template is set.
+        """
+
+        opts = self.model._meta
+        return [
+            "admin/{}/{}/tracking_report_error.html".format(opts.app_label, opts.model_name),
+            "admin/{}/tracking_report_error.html".format(opts.app_label),
+            "admin/tracking_report_error.html"
+        ]
 
     def render_report_error(self, request, error, status):
         """
@@ -178,11 +360,8 @@ class TrackedLiveAdmin(ModelAdmin):
             opts=opts, app_label=app_label, error=error
         )
 
-        return TemplateResponse(request, self.report_error_template or [
-            "admin/{}/{}/tracking_report_error.html".format(app_label, opts.model_name),
-            "admin/{}/tracking_report_error.html".format(app_label),
-            "admin/tracking_report_error.html"
-        ], context, status=status)
+        return TemplateResponse(request, self.report_error_template or self._report_error_templates,
+                                context, status=status)
 
     def get_period_queryset(self, request, period):
         """
@@ -195,14 +374,11 @@ class TrackedLiveAdmin(ModelAdmin):
         qs = self.get_queryset(request)
         if not period:
             return qs
-        if self.tracked_stamps == 'create':
-            return getattr(qs, 'created_on')(period)
-        elif self.tracked_stamps == 'update':
-            return getattr(qs, 'updated_on')(period)
-        elif self.tracked_stamps == 'both':
-            return getattr(qs, 'created_or_updated_on')(period)
-        else:
+        try:
+            method = _TRACKED_STAMPS_METHODS[self.tracked_stamps]
+        except KeyError:
             raise ValueError("Invalid tracked_stamps type. Expected: 'create', 'update', or 'both'")
+        return getattr(qs, method)(period)
 
     def report_view(self, request, key, period):
         """
@@ -212,21 +388,18 @@ class TrackedLiveAdmin(ModelAdmin):
         if not self.has_change_permission(request, None):
             raise PermissionDenied
 
-        reporters = self.get_reporters()
-        try:
-            reporter = reporters[key]
-        except KeyError:
+        reporter = self.get_reporters().get(key)
+        if reporter is None:
             return self.render_report_error(request, _('Report not found'), 404)
 
-        allowed_periods = [k for (k, v) in self.get_period_options()]
         if period == 'A':
             period = ''
 
-        if period and period not in allowed_periods:
+        if period and period not in self._allowed_period_keys:
             return self.render_report_error(request, _('Invalid report type'), 400)
 
         try:
             return reporter.process(request, self.get_period_queryset(request, period), period)
-        except:
+        except Exception:
             logger.exception('Tracking Reports could not generate the report due to an internal error')
             return self.render_report_error(request, _('An unexpected error has occurred'), 500)
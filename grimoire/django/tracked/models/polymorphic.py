@@ -1,4 +1,3 @@
-from __future__ import unicode_literals, absolute_import
 from cantrips.features import Feature
 from django.core.exceptions import ImproperlyConfigured
 from .common import define_all
@@ -1,19 +1,86 @@
-from io import StringIO
-from abc import ABCMeta, abstractmethod
+from abc import ABC, abstractmethod
 from collections import namedtuple
-from cantrips import functions
+from contextvars import ContextVar
+from functools import lru_cache
+from operator import attrgetter, methodcaller
+from django.apps import apps
+from django.db import connections
 from django.utils.text import capfirst
 from django.utils.timezone import now
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
+import itertools
 import datetime
+import inspect
+import logging
 import csv
 
 
+logger = logging.getLogger(__name__)
+
+
 TrackingReportColumn = namedtuple('TrackingReportColumn', ('header', 'fetcher'))
 TrackingReportResult = namedtuple('TrackingReportResult', ('headers', 'values'))
+_ReportPlan = namedtuple('_ReportPlan', ('headers', 'fetchers', 'queried_fields', 'serializers'))
+_MAX_REPORT_PLANS = 32
+# Whether the report being processed (in the current context) fetches its rows through cacheops.
+_caching_rows = ContextVar('_caching_rows', default=False)
+_FIELD, _MODEL_METHOD, _MODEL_PROPERTY, _REPORT_METHOD, _CALLABLE = range(5)
+
+
+@lru_cache(maxsize=None)
+def _model_fields(model):
+    """
+    Returns the fields in the model, by name. This is computed once per model.
+    :param model: model to analyze.
+    :return: A dictionary of fields by name, in declaration order.
+    """
+
+    return {field.name: field for field in model._meta.fields}
 
 
-class TrackingReport(object):
+def _log_stream_errors(chunks):
+    """
+    Yields the given chunks, logging any error raised while generating them. Such errors
+      happen once the response has started, so they can only be logged and re-raised.
+    :param chunks: An iterable of content chunks.
+    :return: An iterator of content chunks.
+    """
+
+    try:
+        for chunk in chunks:
+            yield chunk
+    except Exception:
+        logger.exception('Tracking Reports could not stream the report due to an internal error')
+        raise
+
+
+def _serialize_rows(rows, serializers):
+    """
+    Converts rows of values into rows of cells. Only the columns having a serializer are
+      converted: values in other columns are kept as they are.
+    :param rows: An iterable of value tuples.
+    :param serializers: A list of (column index, serializer function) pairs.
+    :return: An iterator of cell lists.
+    """
+
+    for values in rows:
+        row = list(values)
+        for index, serializer in serializers:
+            row[index] = serializer(row[index])
+        yield row
+
+
+class Echo(object):
+    """
+    File-like object which just returns what is written into it. Writers (like csv.writer)
+      using it will return the serialized content instead of buffering it.
+    """
+
+    def write(self, value):
+        return value
+
+
+class TrackingReport(ABC):
     """
     This is an abstract class to process a report for a given format, model, and period.
     Stuff must be defined like:
@@ -25,6 +92,17 @@ class TrackingReport(object):
     4. The attachment content. This MUST be defined by overriding `get_attachment_content` method.
     5. The fields to report. This can be defined by overriding `get_list_report` method or just
        the `list_report` member (a list of strings).
+    6. Whether the content is streamed. Reports setting the `streaming` member to True will send
+       the content, as it is generated by `iter_report_content`, in a streaming response. Reports
+       overriding `get_attachment_content` (or, for CSV reports, `dump_report_content`) are not streamed.
+    7. The amount of rows fetched at once from the database. This can be defined by setting the
+       `chunk_size` member (an integer). Reports iterating querysets on their own should do it
+       through `iter_queryset`, which honors it.
+    8. Whether the queried rows are cached. This can be defined by setting the `cache_timeout`
+       member (seconds) and requires django-cacheops to be installed. Cached rows are fetched
+       at once instead of in chunks. Only the "all the records" report is cached: period reports
+       filter by the current time, so their queries (and cache keys) never repeat, and caching
+       them would just load all the rows in memory and store a cache entry never read again.
     """
 
     list_report = []
@@ -32,8 +110,10 @@ class TrackingReport(object):
     date_format = "%Y-%m-%d"
     time_format = "%H:%M:%S"
 
-    __metaclass__ = ABCMeta
     content_type = None
+    streaming = False
+    chunk_size = 2000
+    cache_timeout = None
 
     def __init__(self, key, text):
         """
@@ -44,6 +124,7 @@ class TrackingReport(object):
 
         self._key = key
         self._text = text
+        self._report_plans = {}
 
     def _serialize_value(self, value):
         """
@@ -69,6 +150,34 @@ class TrackingReport(object):
 
         return self._serialize_value(value)
 
+    def _cell_serializer(self, field):
+        """
+        Returns the function computing cell values for a given model field. Since the type
+          of the values is known from the field, date and time values are formatted without
+          checking the type of each value, and non-null text values are not converted at all.
+          Reports overriding `_cell_value` or `_serialize_value` get their `_cell_value` instead.
+        :param field: model field being reported.
+        :return: a function taking the field value and returning an appropriate cell value, or
+          None if the field values are already appropriate cell values.
+        """
+
+        cls = type(self)
+        if cls._cell_value is not TrackingReport._cell_value or \
+           cls._serialize_value is not TrackingReport._serialize_value:
+            return self._cell_value
+        internal_type = field.get_internal_type()
+        if internal_type in ('CharField', 'SlugField', 'TextField') and not field.null:
+            return None
+        elif internal_type == 'DateTimeField':
+            fmt = self.datetime_format
+        elif internal_type == 'DateField':
+            fmt = self.date_format
+        elif internal_type == 'TimeField':
+            fmt = self.time_format
+        else:
+            return str
+        return lambda value, _f=fmt, _s=str: _s(value) if value is None else value.strftime(_f)
+
     @property
     def key(self):
         return self._key
@@ -95,6 +204,113 @@ class TrackingReport(object):
 
         return self.list_report
 
+    def _classify_report_item(self, model, fields, list_report_item):
+        """
+        Tells which kind of column a `list_report` item is. Members are looked up statically,
+          so no descriptor is triggered while classifying them.
+        :param model: model being reported.
+        :param fields: model fields, by name.
+        :param list_report_item: item to classify.
+        :return: A (kind, target) pair. The target is the model field, the model method, the
+          model property, the bound report method, or the callable, respectively.
+        """
+
+        if list_report_item in fields:
+            return _FIELD, fields[list_report_item]
+
+        if isinstance(list_report_item, str):
+            # model member (method or property)
+            model_member = inspect.getattr_static(model, list_report_item, None)
+            # method check
+            if inspect.isfunction(model_member) or isinstance(model_member, (classmethod, staticmethod)):
+                return _MODEL_METHOD, getattr(model, list_report_item)
+            # property check
+            if isinstance(model_member, property):
+                if model_member.fget is not None:
+                    return _MODEL_PROPERTY, model_member
+                raise ValueError('Property item in `list_report` member, or returned by `get_list_report()` '
+                                 'must be readable')
+            # report member (method)
+            report_member = inspect.getattr_static(self, list_report_item, None)
+            if inspect.isfunction(report_member) or isinstance(report_member, (classmethod, staticmethod)):
+                return _REPORT_METHOD, getattr(self, list_report_item)
+
+        # regular callable
+        if callable(list_report_item):
+            return _CALLABLE, list_report_item
+
+        # invalid value
+        raise TypeError('Item in `list_report` member, or returned by `get_list_report()` must be a model '
+                        'field name, or model instance method, current report''s instance method, or '
+                        'a regular callable')
+
+    def _get_report_plan(self, request, model):
+        """
+        Computes everything needed to report a model: the column header texts (not translated
+          yet, since they may be lazy), the value fetchers, the fields to query and, when only
+          non-relational fields are reported, the (index, serializer) pairs to apply to the
+          queried values. Plans are cached by model and reported items, so they are built only
+          once. At most _MAX_REPORT_PLANS plans are kept: reported items built on each request
+          (e.g. lambdas) are never reused, and would only grow the cache.
+        :param request: current request being processed.
+        :param model: model to analyze and fetch.
+        :return: A _ReportPlan. Its serializers are None if model instances must be fetched.
+        """
+
+        list_report = self.get_list_report(request)
+        cache_key = (model, tuple(list_report or ()))
+        plan = self._report_plans.get(cache_key)
+        if plan is not None:
+            return plan
+        if len(self._report_plans) >= _MAX_REPORT_PLANS:
+            self._report_plans.clear()
+
+        fields = _model_fields(model)
+        list_report = list_report or tuple(fields)
+        _s = self._cell_value
+
+        def header(list_report_item, kind, target):
+            if kind == _FIELD:
+                return target.verbose_name
+            elif kind == _CALLABLE:
+                return (getattr(target, 'short_description', None) or
+                        getattr(target, '__name__', None) or '<unknown>')
+            else:
+                return getattr(target, 'short_description', list_report_item.replace('_', ' '))
+
+        def fetcher(list_report_item, kind, target):
+            # Values are read by attrgetter / methodcaller objects (or already bound methods)
+            #   created once per column, instead of resolving the member by name on each row.
+            if kind == _FIELD:
+                getter = attrgetter(list_report_item)
+                serializer = self._cell_serializer(target)
+                if serializer is None:
+                    return getter
+                return lambda obj, _g=getter, _c=serializer: _c(_g(obj))
+            elif kind == _MODEL_METHOD:
+                return lambda obj, _g=methodcaller(list_report_item), _s=_s: _s(_g(obj))
+            elif kind == _MODEL_PROPERTY:
+                return lambda obj, _g=attrgetter(list_report_item), _s=_s: _s(_g(obj))
+            else:
+                return lambda obj, _g=target, _s=_s: _s(_g(obj))
+
+        headers = []
+        fetchers = []
+        for item in list_report:
+            kind, target = self._classify_report_item(model, fields, item)
+            headers.append(header(item, kind, target))
+            fetchers.append(fetcher(item, kind, target))
+        if all(item in fields and not fields[item].is_relation for item in list_report):
+            queried_fields = list(list_report)
+            serializers = [(index, serializer) for index, serializer in
+                           enumerate(self._cell_serializer(fields[item]) for item in queried_fields)
+                           if serializer is not None]
+        else:
+            queried_fields = [item for item in list_report if item in fields] or ['id']
+            serializers = None
+        plan = self._report_plans[cache_key] = _ReportPlan(headers, fetchers, queried_fields, serializers)
+        return plan
+
     def get_report_column_builders(self, request, model):
         """
         Returns builders for column names and column values
@@ -106,97 +322,50 @@ class TrackingReport(object):
         :return: A list of TrackingReportColumn pairs.
         """
 
-        meta = model._meta
-        field_names = set(field.name for field in meta.fields)
-        list_report = self.get_list_report(request) or field_names
-        _s = self._cell_value
+        plan = self._get_report_plan(request, model)
+        return [TrackingReportColumn(header=str(capfirst(header)), fetcher=fetcher)
+                for header, fetcher in zip(plan.headers, plan.fetchers)]
 
-        def header(list_report_item):
-            if list_report_item in field_names:
-                return str(capfirst(meta.get_field(list_report_item).verbose_name))
-            else:
-                if isinstance(list_report_item, str):
-                    # model member (method or property)
-                    model_member = getattr(model, list_report_item, None)
-                    # method check
-                    if functions.is_method(model_member, functions.METHOD_UNBOUND|functions.METHOD_INSTANCE):
-                        return str(capfirst(getattr(model_member, 'short_description',
-                                                    list_report_item.replace('_', ' '))))
-                    # property check
-                    if isinstance(model_member, property):
-                        if model_member.getter:
-                            return str(capfirst(getattr(model_member, 'short_description',
-                                                              list_report_item.replace('_', ' '))))
-                        raise ValueError('Property item in `list_report` member, or returned by `get_list_report()` '
-                                         'must be readable')
-                    # report member (method)
-                    report_member = getattr(self, list_report_item, None)
-                    if functions.is_method(report_member, functions.METHOD_UNBOUND|functions.METHOD_INSTANCE):
-                        return str(capfirst(getattr(report_member, 'short_description',
-                                                    list_report_item.replace('_', ' '))))
-
-                # regular callable
-                if callable(list_report_item):
-                    return str(capfirst(getattr(list_report_item, 'short_description', None) or
-                                        getattr(list_report_item, '__name__', None) or '<unknown>'))
-
-                # invalid value
-                raise TypeError('Item in `list_report` member, or returned by `get_list_report()` must be a model '
-                                'field name, or model instance method, current report''s instance method, or '
-                                'a regular callable')
-
-        def fetcher(list_report_item):
-            if list_report_item in field_names:
-                return lambda obj: _s(getattr(obj, list_report_item))
-            else:
-                if isinstance(list_report_item, str):
-                    # model member (method or property)
-                    model_member = getattr(model, list_report_item, None)
-                    # method check
-                    if functions.is_method(model_member, functions.METHOD_UNBOUND|functions.METHOD_INSTANCE):
-                        return lambda obj: _s(getattr(obj, list_report_item)())
-                    # property check
-                    if isinstance(model_member, property):
-                        if model_member.getter:
-                            return lambda obj: _s(getattr(obj, list_report_item))
-                        raise ValueError('Property item in `list_report` member, or returned by `get_list_report()` '
-                                         'must be readable')
-                    # report member (method)
-                    report_member = getattr(self, list_report_item, None)
-                    if functions.is_method(report_member, functions.METHOD_UNBOUND|functions.METHOD_INSTANCE):
-                        return lambda obj: _s(getattr(self, list_report_item)(obj))
-
-                # regular callable
-                if callable(list_report_item):
-                    return lambda obj: _s(list_report_item(obj))
-
-                # invalid value
-                raise TypeError('Item in `list_report` member, or returned by `get_list_report()` must be a model '
-                                'field name, or model instance method, current report''s instance method, or '
-                                'a regular callable')
-
-        return [TrackingReportColumn(header=header(item), fetcher=fetcher(item)) for item in list_report]
+    def iter_queryset(self, queryset):
+        """
+        Iterates a queryset in chunks of `chunk_size` rows, without caching its results. If a
+          `cache_timeout` is set, django-cacheops is installed, and the "all the records" report
+          is being processed, the results are fetched at once through the cacheops cache instead
+          (cacheops does not cache `.iterator()`).
+        :param queryset: The queryset to iterate.
+        :return: An iterator over the queryset results.
+        """
+
+        if _caching_rows.get() and apps.is_installed('cacheops'):
+            return iter(queryset.cache(timeout=self.cache_timeout))
+        return queryset.iterator(chunk_size=self.chunk_size)
 
     def get_report_data_rows(self, request, queryset):
         """
         Using the builders for the queryset model, iterates over the queryset to generate a result
           with headers and rows. This queryset must be the exact same received in the .process method,
           which tells us that this function should be called inside .process implementation.
+        Rows are lazily generated: they are fetched from the database, in chunks of `chunk_size` rows
+          (using a server-side cursor where the database supports it), while being iterated. They can
+          be iterated only once, and the queryset must not be altered while they are. When only
+          non-relational fields are reported (and `get_report_column_builders` is not overridden),
+          rows are fetched as tuples of values, and no model instance is created.
         :param queryset: Provided queryset
         :return: Result with headers and rows
         """
 
-        model = queryset.model
-        meta = model._meta
-        field_names = set(field.name for field in meta.fields)
-        list_report = self.get_list_report(request) or field_names
-        queried_field_named = [l for l in list_report if l in field_names] or ['id']
-
-        columns = self.get_report_column_builders(request, model)
+        plan = self._get_report_plan(request, queryset.model)
+        columns = self.get_report_column_builders(request, queryset.model)
         headers = [column.header for column in columns]
-        rows = []
-        for instance in queryset.only(*queried_field_named):
-            rows.append([column.fetcher(instance) for column in columns])
+        if plan.serializers is not None and \
+           type(self).get_report_column_builders is TrackingReport.get_report_column_builders:
+            # Prefetching does not apply to value tuples.
+            values = queryset.prefetch_related(None).values_list(*plan.queried_fields)
+            rows = _serialize_rows(self.iter_queryset(values), plan.serializers)
+        else:
+            fetchers = [column.fetcher for column in columns]
+            rows = ([fetcher(instance) for fetcher in fetchers]
+                    for instance in self.iter_queryset(queryset.only(*plan.queried_fields)))
 
         return TrackingReportResult(headers=headers, values=rows)
 
@@ -222,6 +391,17 @@ class TrackingReport(object):
 
         return b''
 
+    def iter_report_content(self, request, result):
+        """
+        Dumps the content as an iterable of chunks, suitable to being streamed. By default, the whole
+          content is dumped in a single chunk, by calling `dump_report_content`.
+        :param request: Request being processed.
+        :param result: Result being dumped.
+        :return: An iterable of dumped strings.
+        """
+
+        yield self.dump_report_content(request, result)
+
     def get_attachment_content(self, request, queryset):
         """
         Returns the generated file content.
@@ -232,19 +412,56 @@ class TrackingReport(object):
 
         return self.dump_report_content(request, self.get_report_data_rows(request, queryset))
 
+    def iter_attachment_content(self, request, queryset):
+        """
+        Returns the generated file content, as an iterable of chunks.
+        :param request: The request being processed.
+        :param queryset: The model class being processed.
+        :return: An iterable of report content chunks.
+        """
+
+        return self.iter_report_content(request, self.get_report_data_rows(request, queryset))
+
+    def _streams(self):
+        """
+        Tells whether the content is streamed. Streamed content is generated by `iter_attachment_content`,
+          so reports overriding `get_attachment_content` are not streamed: their content would be ignored.
+        :return: A boolean.
+        """
+
+        return self.streaming and type(self).get_attachment_content is TrackingReport.get_attachment_content
+
     def process(self, request, queryset, period):
         """
         Will process the request and return an appropriate Response object.
+        Streamed reports generate their first chunks (usually the header and the first row) here,
+          so errors in the query or in the reported columns are raised before responding. Errors
+          occurring later, while streaming, are logged and abort the (truncated) response. Reports
+          processed inside an atomic block are not streamed.
         :param request: The request being processed.
         :param model: The model class being processed.
         :param period: The model being processed.
         :return: The response with the report.
         """
 
-        response = HttpResponse(content=self.get_attachment_content(request, queryset) or '',
-                                content_type=self.get_attachment_content_type(request) or 'text/plain')
-        response['Content-Disposition'] = 'attachment; filename=' + (self.get_attachment_filename(request, period) or
-                                                                     'report.txt')
+        content_type = self.get_attachment_content_type(request) or 'text/plain'
+        # The rows query is built (and, when cached, performed) while the content iteration starts.
+        token = _caching_rows.set(self.cache_timeout is not None and not period)
+        try:
+            # Streamed rows are fetched after the view returns: within an atomic block (e.g. with
+            #   ATOMIC_REQUESTS) the transaction, and the server-side cursor with it, is gone by then.
+            if self._streams() and not connections[queryset.db].in_atomic_block:
+                chunks = iter(self.iter_attachment_content(request, queryset))
+                first_chunks = list(itertools.islice(chunks, 2))
+                response = StreamingHttpResponse(_log_stream_errors(itertools.chain(first_chunks, chunks)),
+                                                 content_type=content_type)
+            else:
+                response = HttpResponse(content=self.get_attachment_content(request, queryset) or '',
+                                        content_type=content_type)
+        finally:
+            _caching_rows.reset(token)
+        filename = self.get_attachment_filename(request, period) or 'report.txt'
+        response['Content-Disposition'] = 'attachment; filename=%s' % filename
         return response
 
 
@@ -286,6 +503,7 @@ class CSVReport(TrackingReport):
     """
 
     csv_kwargs = {}
+    streaming = True
 
     def get_attachment_filename(self, request, period):
         """
@@ -297,6 +515,15 @@ class CSVReport(TrackingReport):
 
         return 'report-%s.csv' % now().strftime("%Y%m%d%H%M%S")
 
+    def _streams(self):
+        """
+        Tells whether the content is streamed. CSV lines are streamed by `iter_report_content` without
+          calling `dump_report_content`, so reports overriding it are not streamed either.
+        :return: A boolean.
+        """
+
+        return super(CSVReport, self)._streams() and type(self).dump_report_content is CSVReport.dump_report_content
+
     def dump_report_content(self, request, result):
         """
         Dumps the content to a string, suitable to being written on a file.
@@ -304,7 +531,16 @@ class CSVReport(TrackingReport):
         :return: string
         """
 
-        output = StringIO()
-        writer = csv.writer(output, **self.csv_kwargs)
-        writer.writerows([result.headers] + result.values)
-        return output.getvalue()
+        return ''.join(self.iter_report_content(request, result))
+
+    def iter_report_content(self, request, result):
+        """
+        Dumps the content line by line, suitable to being streamed.
+        :param result: The result being processed.
+        :return: An iterable of strings (one per CSV line).
+        """
+
+        writerow = csv.writer(Echo(), **self.csv_kwargs).writerow
+        yield writerow(result.headers)
+        for row in result.values:
+            yield writerow(row)
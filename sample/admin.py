@@ -1,5 +1,5 @@
 from django.contrib.admin import site, ModelAdmin
-from django.utils.translation import ugettext_lazy as _
+from django.utils.translation import gettext_lazy as _
 from grimoire.django.tracked.admin import TrackedLiveAdmin
 from grimoire.django.tracked.reports import CSVReport
 from .models import SampleRecord, uppercase_content